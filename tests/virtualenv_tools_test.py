@@ -1,41 +1,92 @@
-import collections
+import compileall
+import marshal
 import os
-import pipes
 import platform
+import re
+import shutil
 import subprocess
 import sys
+from types import CodeType
+from types import SimpleNamespace
 
 import pytest
+from filelock import FileLock
+from virtualenv import cli_run
 
 import virtualenv_tools
 
-
-def auto_namedtuple(**kwargs):
-    return collections.namedtuple('ns', tuple(kwargs))(**kwargs)
+if platform.python_implementation() == 'PyPy':  # pragma: no cover (pypy)
+    libdir_fmt = 'lib-python/{}.{}'
+else:  # pragma: no cover (non-pypy)
+    libdir_fmt = 'lib/python{}.{}'
+LIBDIR = libdir_fmt.format(*sys.version_info[:2])
 
 
-@pytest.fixture
-def venv(tmpdir):
-    app_before = tmpdir.join('before').ensure_dir()
-    app_before.join('mymodule.py').write(
+def _build_seed_venv(app):
+    """Creates the application and installs it in its virtualenv."""
+    app.mkdir()
+    (app / 'mymodule.py').write_text(
         "if __name__ == '__main__':\n"
         "    print('ohai!')\n"
     )
-    app_before.join('setup.py').write(
+    (app / 'setup.py').write_text(
         'from setuptools import setup\n'
         'setup(name="mymodule", py_modules=["mymodule"])\n'
     )
-    venv_before = app_before.join('venv')
-    app_after = tmpdir.join('after')
-    venv_after = app_after.join('venv')
+    venv = app / 'venv'
 
-    cmd = (sys.executable, '-m', 'virtualenv', venv_before.strpath)
-    subprocess.check_call(cmd)
+    cli_run((str(venv), '--no-periodic-update'))
     subprocess.check_call((
-        venv_before.join('bin/pip').strpath,
-        'install', '-e', app_before.strpath,
+        str(venv / 'bin/pip'),
+        'install', '-e', str(app),
     ))
-    yield auto_namedtuple(
+
+
+@pytest.fixture(scope='session')
+def _seed_venv(tmp_path_factory):
+    """Builds the application and its virtualenv once per session.  With
+    pytest-xdist, the workers share a single build in the run's base
+    temporary directory.  A build that died midway, without its `.ready`
+    marker, is thrown away and redone.
+    """
+    if os.environ.get('PYTEST_XDIST_WORKER') is None:
+        root = tmp_path_factory.getbasetemp()
+    else:  # pragma: no cover (pytest-xdist only)
+        root = tmp_path_factory.getbasetemp().parent
+    seed = root / 'seed'
+    with FileLock(str(root / 'seed.lock')):
+        if not (seed / '.ready').exists():  # pragma: no branch (xdist)
+            shutil.rmtree(str(seed), ignore_errors=True)
+            seed.mkdir()
+            _build_seed_venv(seed / 'app')
+            (seed / '.ready').touch()
+    return seed / 'app'
+
+
+def _clone_app(seed, dest):
+    """Copies the seed application to `dest` and points the absolute paths
+    written by virtualenv and pip to the copy.
+    """
+    shutil.copytree(seed, dest, symlinks=True)
+    old, new = os.fsencode(seed), os.fsencode(dest)
+    venv = dest / 'venv'
+    for directory in (venv, venv / 'bin', venv / LIBDIR / 'site-packages'):
+        for path in directory.iterdir():
+            if path.is_symlink() or not path.is_file():
+                continue
+            content = path.read_bytes()
+            if old in content:
+                path.write_bytes(content.replace(old, new))
+
+
+@pytest.fixture
+def venv(tmp_path, _seed_venv):
+    app_before = tmp_path / 'before'
+    _clone_app(_seed_venv, app_before)
+    venv_before = app_before / 'venv'
+    app_after = tmp_path / 'after'
+    venv_after = app_after / 'venv'
+    return SimpleNamespace(
         app_before=app_before, app_after=app_after,
         before=venv_before, after=venv_after,
     )
@@ -43,7 +94,7 @@ def venv(tmpdir):
 
 def run(before, after, args=()):
     ret = virtualenv_tools.main(
-        (before.strpath, '--update-path={}'.format(after.strpath)) + args,
+        (str(before), '--update-path={}'.format(after)) + args,
     )
     assert ret == 0
 
@@ -58,7 +109,7 @@ def test_help(capsys, helpargs):
 
 # To avoid WORKON_HOME variable already set
 @pytest.fixture(autouse=True)
-def env_setup(venv, monkeypatch):
+def env_setup(monkeypatch):
     if 'WORKON_HOME' in os.environ:
         monkeypatch.delenv('WORKON_HOME')
 
@@ -69,13 +120,13 @@ def test_already_up_to_date(venv, capsys):
     assert out == 'Already up-to-date: {0} ({0})\n'.format(venv.before)
 
 
-def test_each_part_idempotent(tmpdir, venv, capsys):
-    activate = venv.before.join('bin/activate')
-    before_activate_contents = activate.read()
+def test_each_part_idempotent(venv, capsys):
+    activate = venv.before / 'bin/activate'
+    before_activate_contents = activate.read_text()
     run(venv.before, venv.after)
     capsys.readouterr()
     # Write the activate file to trick the logic into rerunning
-    activate.write(before_activate_contents)
+    activate.write_text(before_activate_contents)
     run(venv.before, venv.after, args=('--verbose',))
     out, _ = capsys.readouterr()
     # Should only update our activate file:
@@ -85,28 +136,34 @@ def test_each_part_idempotent(tmpdir, venv, capsys):
     assert out == expected
 
 
-def _assert_activated_sys_executable(path):
-    exe = subprocess.check_output((
-        'bash', '-c',
-        ". {} && python -c 'import sys; print(sys.executable)'".format(
-            pipes.quote(path.join('bin/activate').strpath),
-        )
-    )).decode('UTF-8').strip()
-    assert exe == path.join('bin/python').strpath
+_CHECK_STATE_SCRIPT = (
+    'import runpy, sys; '
+    'print(sys.executable); '
+    'runpy.run_module("mymodule", run_name="__main__")'
+)
+_VIRTUAL_ENV_RE = re.compile(r'^VIRTUAL_ENV=[\'"]?(.*?)[\'"]?$', re.MULTILINE)
+
+
+def _activated_env(path):
+    """Returns the environment sourcing bin/activate would set up."""
+    activate = (path / 'bin/activate').read_text()
+    virtual_env = _VIRTUAL_ENV_RE.search(activate).group(1)
+    env = dict(os.environ, VIRTUAL_ENV=virtual_env)
+    env['PATH'] = os.pathsep.join((os.path.join(virtual_env, 'bin'), env['PATH']))
+    env.pop('PYTHONHOME', None)
+    return env
 
 
-def _assert_mymodule_output(path):
+def assert_virtualenv_state(path):
+    # A single interpreter, looked up in the PATH of the activated
+    # environment, reports its executable and runs mymodule.
     out = subprocess.check_output(
-        (path.join('bin/python').strpath, '-m', 'mymodule'),
+        ('python', '-c', _CHECK_STATE_SCRIPT),
+        env=_activated_env(path),
         # Run from '/' to ensure we're not importing from .
         cwd='/',
     ).decode('UTF-8')
-    assert out == 'ohai!\n'
-
-
-def assert_virtualenv_state(path):
-    _assert_activated_sys_executable(path)
-    _assert_mymodule_output(path)
+    assert out == '{}\nohai!\n'.format(path / 'bin/python')
 
 
 def test_move(venv, capsys):
@@ -115,20 +172,20 @@ def test_move(venv, capsys):
     out, _ = capsys.readouterr()
     expected = 'Updated: {0} ({0} -> {1})\n'.format(venv.before, venv.after)
     assert out == expected
-    venv.app_before.move(venv.app_after)
+    shutil.move(str(venv.app_before), str(venv.app_after))
     assert_virtualenv_state(venv.after)
 
 
 def test_move_non_ascii_script(venv, capsys):
     # We have a script with non-ascii bytes which we
     # want to install non-editable.
-    venv.app_before.join('mymodule.py').write_binary(
+    (venv.app_before / 'mymodule.py').write_bytes(
         b"#!/usr/bin/env python\n"
         b'"""Copyright: \xc2\xa9 Me"""\n'
         b"if __name__ == '__main__':\n"
         b"    print('ohai!')\n"
     )
-    venv.app_before.join('setup.py').write(
+    (venv.app_before / 'setup.py').write_text(
         'from setuptools import setup\n'
         'setup('
         '   name="mymodule", '
@@ -137,8 +194,8 @@ def test_move_non_ascii_script(venv, capsys):
         ')\n'
     )
     subprocess.check_call((
-        venv.before.join('bin/pip').strpath,
-        'install', '--upgrade', venv.app_before.strpath,
+        str(venv.before / 'bin/pip'),
+        'install', '--upgrade', str(venv.app_before),
     ))
 
     assert_virtualenv_state(venv.before)
@@ -146,14 +203,14 @@ def test_move_non_ascii_script(venv, capsys):
     out, _ = capsys.readouterr()
     expected = 'Updated: {0} ({0} -> {1})\n'.format(venv.before, venv.after)
     assert out == expected
-    venv.app_before.move(venv.app_after)
+    shutil.move(str(venv.app_before), str(venv.app_after))
     assert_virtualenv_state(venv.after)
 
 
 def test_move_with_venv(venv, capsys):
     assert_virtualenv_state(venv.before)
-    os.environ['WORKON_HOME'] = venv.app_after.strpath
-    venv.app_before.move(venv.app_after)
+    os.environ['WORKON_HOME'] = str(venv.app_after)
+    shutil.move(str(venv.app_before), str(venv.app_after))
     ret = virtualenv_tools.main(('venv',))
     out, _ = capsys.readouterr()
     expected = 'Updated: {0} ({0} -> {1})\n'.format(venv.before, venv.after)
@@ -164,54 +221,218 @@ def test_move_with_venv(venv, capsys):
 
 def test_move_with_pyvencfg(venv, capsys):
     assert_virtualenv_state(venv.before)
-    venv.app_before.move(venv.app_after)
+    shutil.move(str(venv.app_before), str(venv.app_after))
     ret = virtualenv_tools.main((
         '--base-python-dir=/usr/bin/python',
-        venv.after.strpath,
+        str(venv.after),
     ))
-    pyvenv = venv.after.join('pyvenv.cfg')
-    pyvenv_content = pyvenv.readlines()
+    pyvenv = venv.after / 'pyvenv.cfg'
+    pyvenv_content = pyvenv.read_text().splitlines(keepends=True)
     expected = 'home = /usr/bin/python\n'
     assert ret == 0
     assert pyvenv_content[0] == expected
     assert_virtualenv_state(venv.after)
 
 
-if platform.python_implementation() == 'PyPy':  # pragma: no cover (pypy)
-    libdir_fmt = 'lib-python/{}.{}'
-else:  # pragma: no cover (non-pypy)
-    libdir_fmt = 'lib/python{}.{}'
-
-
 def test_bad_pyc(venv, capsys):
-    libdir = libdir_fmt.format(*sys.version_info[:2])
-    bad_pyc = venv.before.join(libdir, 'bad.pyc')
-    bad_pyc.write_binary(b'I am a very naughty pyc\n')
+    bad_pyc = venv.before / LIBDIR / 'bad.pyc'
+    bad_pyc.write_bytes(b'I am a very naughty pyc\n')
     run(venv.before, venv.after)
     out, _ = capsys.readouterr()
-    expected = 'Error in {0}\nUpdated: {1} ({1} -> {2})\n'.format(bad_pyc.strpath, venv.before, venv.after)
+    expected = 'Error in {0}\nUpdated: {1} ({1} -> {2})\n'.format(bad_pyc, venv.before, venv.after)
     assert out == expected
 
 
 def test_clean_pyc(venv, capsys):
-    libdir = libdir_fmt.format(*sys.version_info[:2])
-    bad_pyc = venv.before.join(libdir, 'bad.pyc')
-    bad_pyc.write_binary(b'I am a very naughty pyc\n')
+    bad_pyc = venv.before / LIBDIR / 'bad.pyc'
+    bad_pyc.write_bytes(b'I am a very naughty pyc\n')
     run(venv.before, venv.after, ('--clean',))
     out, _ = capsys.readouterr()
-    expected = 'Error in {0}\nDeleted {0}\nUpdated: {1} ({1} -> {2})\n'.format(bad_pyc.strpath, venv.before, venv.after)
+    expected = 'Error in {0}\nDeleted {0}\nUpdated: {1} ({1} -> {2})\n'.format(bad_pyc, venv.before, venv.after)
     assert out == expected
 
 
+def _compile_module(venv_path):
+    """Writes a module with nested code objects (a function, a class and
+    its method) in site-packages and returns the path of its pyc.
+    """
+    module = venv_path / LIBDIR / 'site-packages/pyc_module.py'
+    module.write_text(
+        'def func():\n'
+        '    return 1\n'
+        '\n'
+        '\n'
+        'class Class:\n'
+        '    def method(self):\n'
+        '        return func()\n'
+    )
+    compileall.compile_file(str(module), quiet=1)
+    pyc, = module.parent.glob('__pycache__/pyc_module.*.pyc')
+    return pyc
+
+
+@pytest.mark.parametrize('threshold', (10 ** 6, 0), ids=('serial', 'parallel'))
+def test_pyc_filenames_updated(venv, monkeypatch, threshold):
+    monkeypatch.setattr(virtualenv_tools, 'PARALLEL_PYCS_THRESHOLD', threshold)
+    pyc = _compile_module(venv.before)
+    run(venv.before, venv.after)
+    codes = [marshal.loads(pyc.read_bytes()[virtualenv_tools.MAGIC_LENGTH:])]
+    # Nested code objects (functions, classes) are updated as well
+    seen = 0
+    while codes:
+        code = codes.pop()
+        seen += 1
+        assert code.co_filename == str(venv.after / pyc.name)
+        codes.extend(c for c in code.co_consts if isinstance(c, CodeType))
+    # The module, func, Class and Class.method
+    assert seen == 4
+
+
+def test_pyc_already_up_to_date_not_rewritten(venv, capsys):
+    _compile_module(venv.before)
+    run(venv.before, venv.after, args=('--verbose',))
+    out, _ = capsys.readouterr()
+    assert any(line.startswith('B ') for line in out.splitlines())
+    run(venv.before, venv.after, args=('--verbose', '--force'))
+    out, _ = capsys.readouterr()
+    assert not any(line.startswith('B ') for line in out.splitlines())
+
+
+def test_pyc_up_to_date_not_rebuilt(tmp_path, monkeypatch):
+    pyc = tmp_path / 'mod.pyc'
+    new_path = str(tmp_path / 'new/mod.pyc')
+    code = compile('def f():\n    pass\n', new_path, 'exec')
+    pyc.write_bytes(b'\0' * virtualenv_tools.MAGIC_LENGTH + marshal.dumps(code))
+    dumped = []
+    monkeypatch.setattr(
+        virtualenv_tools, 'marshal',
+        SimpleNamespace(loads=marshal.loads, dumps=dumped.append),
+    )
+    assert virtualenv_tools._rewrite_pyc((str(pyc), new_path)) is False
+    assert dumped == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason='needs CodeType.replace')
+def test_pyc_nested_code_filename_updated(tmp_path):  # pragma: no cover (py38+)
+    pyc = tmp_path / 'mod.pyc'
+    new_path = str(tmp_path / 'new/mod.pyc')
+    # The module code already has the new filename, only its function not
+    code = compile('def f():\n    pass\n', '/old/mod.py', 'exec')
+    code = code.replace(co_filename=new_path)
+    pyc.write_bytes(b'\0' * virtualenv_tools.MAGIC_LENGTH + marshal.dumps(code))
+    assert virtualenv_tools._rewrite_pyc((str(pyc), new_path)) is True
+    code = marshal.loads(pyc.read_bytes()[virtualenv_tools.MAGIC_LENGTH:])
+    func, = (c for c in code.co_consts if isinstance(c, CodeType))
+    assert func.co_filename == new_path
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason='needs CodeType.replace')
+def test_pyc_mixed_siblings_updated(tmp_path):  # pragma: no cover (py38+)
+    pyc = tmp_path / 'mod.pyc'
+    new_path = str(tmp_path / 'new/mod.pyc')
+    # Only `f` already has the new filename, `g` and the module do not
+    code = compile('def f():\n    pass\ndef g():\n    pass\n', '/old/mod.py', 'exec')
+    code = code.replace(co_consts=tuple(
+        const.replace(co_filename=new_path)
+        if isinstance(const, CodeType) and const.co_name == 'f' else const
+        for const in code.co_consts
+    ))
+    pyc.write_bytes(b'\0' * virtualenv_tools.MAGIC_LENGTH + marshal.dumps(code))
+    assert virtualenv_tools._rewrite_pyc((str(pyc), new_path)) is True
+    code = marshal.loads(pyc.read_bytes()[virtualenv_tools.MAGIC_LENGTH:])
+    assert code.co_filename == new_path
+    funcs = [c for c in code.co_consts if isinstance(c, CodeType)]
+    assert sorted(func.co_name for func in funcs) == ['f', 'g']
+    assert all(func.co_filename == new_path for func in funcs)
+
+
+def test_activation_script_without_virtual_env_skipped(tmp_path, monkeypatch):
+    script = tmp_path / 'activate.bat'
+    script.write_text('@echo off\n')
+    # Scripts that never mention VIRTUAL_ENV are not even searched
+    monkeypatch.setattr(virtualenv_tools, '_activation_path_re', None)
+    virtualenv_tools.update_activation_script(str(script), '/new')
+    assert script.read_text() == '@echo off\n'
+
+
+def test_activation_script_unquoted_path(tmp_path):
+    script = tmp_path / 'activate'
+    script.write_text('VIRTUAL_ENV=/old\nexport VIRTUAL_ENV\n')
+    virtualenv_tools.update_activation_script(str(script), '/new')
+    assert script.read_text() == 'VIRTUAL_ENV=/new\nexport VIRTUAL_ENV\n'
+
+
+def test_long_shebang_updated(tmp_path):
+    # The shebang line does not fit in the first read of the script
+    args = ' -X' + 'x' * 300
+    script = tmp_path / 'script'
+    script.write_text('#!/old/bin/python{}\nprint("#!/old/bin/python")\n'.format(args))
+    virtualenv_tools.update_script(str(script), '/new/bin')
+    assert script.read_text() == (
+        '#!/new/bin/python{}\nprint("#!/old/bin/python")\n'.format(args)
+    )
+
+
+def test_replace_file_keeps_owner(tmp_path, monkeypatch):
+    target = tmp_path / 'script'
+    target.write_text('old')
+    st = target.stat()
+    chowns = []
+    monkeypatch.setattr(os, 'chown', lambda *args: chowns.append(args))
+    virtualenv_tools._replace_file(str(target), 'new')
+    assert target.read_text() == 'new'
+    (tmp_filename, uid, gid), = chowns
+    assert os.path.dirname(tmp_filename) == str(tmp_path)
+    assert (uid, gid) == (st.st_uid, st.st_gid)
+
+
+def test_get_orig_path_last_line(tmp_path):
+    (tmp_path / 'bin').mkdir()
+    (tmp_path / 'bin/activate').write_text('VIRTUAL_ENV="/venv"')
+    assert virtualenv_tools.get_orig_path(str(tmp_path)) == '/venv'
+
+
+@pytest.mark.parametrize(
+    'activate', (
+        'VIRTUAL_ENV="/venv\nexport VIRTUAL_ENV\n',
+        "VIRTUAL_ENV='/venv",
+        'VIRTUAL_ENV=/venv\n',
+    ),
+)
+def test_get_orig_path_no_quoted_value(tmp_path, activate):
+    (tmp_path / 'bin').mkdir()
+    (tmp_path / 'bin/activate').write_text(activate)
+    with pytest.raises(AssertionError):
+        virtualenv_tools.get_orig_path(str(tmp_path))
+
+
 def test_dir_oddities(venv):
-    bindir = venv.before.join('bin')
+    bindir = venv.before / 'bin'
     # A directory existing in the bin dir
-    bindir.join('im_a_directory').ensure_dir()
+    (bindir / 'im_a_directory').mkdir()
     # A broken symlink
-    bindir.join('bad_symlink').mksymlinkto('/i/dont/exist')
+    (bindir / 'bad_symlink').symlink_to('/i/dont/exist')
     # A file with a shebang-looking start, but not actually
-    bindir.join('not-an-exe').write('#!\nohai')
+    (bindir / 'not-an-exe').write_text('#!\nohai')
+    run(venv.before, venv.after)
+
+
+def test_symlinked_script_not_followed(tmp_path, venv):
+    outside = tmp_path / 'outside_script'
+    outside.write_text('#!{}\n'.format(venv.before / 'bin/python'))
+    (venv.before / 'bin/linked_script').symlink_to(outside)
+    run(venv.before, venv.after)
+    assert outside.read_text() == '#!{}\n'.format(venv.before / 'bin/python')
+
+
+def test_symlinked_activation_script_not_followed(tmp_path, venv):
+    outside = tmp_path / 'outside_activate'
+    content = 'set -gx VIRTUAL_ENV "{}"\n'.format(venv.before)
+    outside.write_text(content)
+    (venv.before / 'bin/activate.fish').unlink()
+    (venv.before / 'bin/activate.fish').symlink_to(outside)
     run(venv.before, venv.after)
+    assert outside.read_text() == content
 
 
 def test_verbose(venv, capsys):
@@ -231,7 +452,7 @@ def test_non_absolute_error_update_path(capsys):
 def test_non_absolute_error_base_python_dir(venv, capsys):
     ret = virtualenv_tools.main((
         '--base-python-dir=.',
-        venv.before.strpath,
+        str(venv.before),
     ))
     out, _ = capsys.readouterr()
     assert ret == 1
@@ -239,8 +460,8 @@ def test_non_absolute_error_base_python_dir(venv, capsys):
 
 
 def test_shebang_cmd_relative(venv, capsys):
-    bad_shebang = venv.before.join('bin', 'bad_shebang')
-    bad_shebang.write('#!../bin/python\n')
+    bad_shebang = venv.before / 'bin/bad_shebang'
+    bad_shebang.write_text('#!../bin/python\n')
     run(venv.before, venv.after)
     out, _ = capsys.readouterr()
     expected = 'Updated: {0} ({0} -> {1})\n'.format(venv.before, venv.after)
@@ -254,53 +475,98 @@ def test_main_nux(capsys):
     assert out == "On *nux, Python installation is not hardcoded in binaries\n"
 
 
-@pytest.fixture
-def fake_venv(tmpdir):
-    tmpdir.join('bin').ensure_dir()
-    tmpdir.join('lib/python2.7/site-packages').ensure_dir()
-    tmpdir.join('bin/activate').write('VIRTUAL_ENV=/venv')
-    yield tmpdir
+@pytest.fixture(
+    params=(
+        # (extra directory, versioned lib directory, its placeholder in
+        #  error messages, site-packages)
+        (None, 'lib/python2.7', 'lib/python#.#', 'lib/python2.7/site-packages'),
+        ('lib_pypy', 'lib-python/2.7', 'lib-python/#.#', 'site-packages'),
+    ),
+    ids=('cpython', 'pypy'),
+)
+def fake_venv(request, tmp_path):
+    extra_dir, lib_dir, lib_dir_placeholder, site_packages = request.param
+    (tmp_path / 'bin').mkdir()
+    if extra_dir is not None:
+        (tmp_path / extra_dir).mkdir()
+    (tmp_path / lib_dir).mkdir(parents=True)
+    (tmp_path / site_packages).mkdir(parents=True, exist_ok=True)
+    (tmp_path / 'bin/activate').write_text('VIRTUAL_ENV=/venv')
+    return SimpleNamespace(
+        path=tmp_path,
+        lib_dir=tmp_path / lib_dir,
+        lib_dir_placeholder=tmp_path / lib_dir_placeholder,
+        site_packages=tmp_path / site_packages,
+    )
 
 
 def test_not_a_virtualenv_missing_site_packages(fake_venv, capsys):
-    fake_venv.join('lib/python2.7/site-packages').remove()
-    ret = virtualenv_tools.main((fake_venv.strpath,))
+    fake_venv.site_packages.rmdir()
+    ret = virtualenv_tools.main((str(fake_venv.path),))
     out, _ = capsys.readouterr()
     assert ret == 1
     expected = '{} is not a virtualenv: not a directory: {}\n'.format(
-        fake_venv, fake_venv.join('lib/python2.7/site-packages'),
+        fake_venv.path, fake_venv.site_packages,
     )
     assert out == expected
 
 
 def test_not_a_virtualenv_missing_bindir(fake_venv, capsys):
-    fake_venv.join('bin').remove()
-    ret = virtualenv_tools.main((fake_venv.strpath,))
+    shutil.rmtree(fake_venv.path / 'bin')
+    ret = virtualenv_tools.main((str(fake_venv.path),))
     out, _ = capsys.readouterr()
     assert ret == 1
     expected = '{} is not a virtualenv: not a directory: {}\n'.format(
-        fake_venv, fake_venv.join('bin'),
+        fake_venv.path, fake_venv.path / 'bin',
     )
     assert out == expected
 
 
 def test_not_a_virtualenv_missing_activate_file(fake_venv, capsys):
-    fake_venv.join('bin/activate').remove()
-    ret = virtualenv_tools.main((fake_venv.strpath,))
+    (fake_venv.path / 'bin/activate').unlink()
+    ret = virtualenv_tools.main((str(fake_venv.path),))
     out, _ = capsys.readouterr()
     assert ret == 1
     expected = '{} is not a virtualenv: not a file: {}\n'.format(
-        fake_venv, fake_venv.join('bin/activate'),
+        fake_venv.path, fake_venv.path / 'bin/activate',
     )
     assert out == expected
 
 
 def test_not_a_virtualenv_missing_versioned_lib_directory(fake_venv, capsys):
-    fake_venv.join('lib/python2.7').remove()
-    ret = virtualenv_tools.main((fake_venv.strpath,))
+    shutil.rmtree(fake_venv.lib_dir)
+    ret = virtualenv_tools.main((str(fake_venv.path),))
     out, _ = capsys.readouterr()
     assert ret == 1
     expected = '{} is not a virtualenv: not a directory: {}\n'.format(
-        fake_venv, fake_venv.join('lib/python#.#'),
+        fake_venv.path, fake_venv.lib_dir_placeholder,
     )
     assert out == expected
+
+
+@pytest.mark.parametrize(
+    ('name', 'expected'), (
+        (b'python', True),
+        (b'python3.9', True),
+        (b'pypy3', True),
+        (b'python.exe', True),
+        (b'env', False),
+        (b'pythonw', False),
+    ),
+)
+def test_is_python_bin(name, expected):
+    assert virtualenv_tools._is_python_bin(name) is expected
+
+
+@pytest.mark.parametrize(
+    ('line', 'expected'), (
+        (b'#!/old/bin/python', b'#!/new/bin/python'),
+        (b'#! /old/bin/python3 -E  -s', b'#! /new/bin/python3 -E  -s'),
+        (b'#!/new/bin/python', None),
+        (b'#!python', None),
+        (b'#!', None),
+        (b'no shebang', None),
+    ),
+)
+def test_update_shebang(line, expected):
+    assert virtualenv_tools._update_shebang(line, b'/new/bin') == expected
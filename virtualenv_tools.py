@@ -14,19 +14,22 @@ from __future__ import print_function
 
 import argparse
 import collections
+import functools
 import marshal
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from types import CodeType
 
 IS_WINDOWS = os.name == "nt"
 BIN_DIR = "Scripts" if IS_WINDOWS else "bin"
 
-ACTIVATION_SCRIPTS = [
+ACTIVATION_SCRIPTS = frozenset((
     'activate',
     'activate.csh',
     'activate.fish',
@@ -34,12 +37,17 @@ ACTIVATION_SCRIPTS = [
     'activate.bat',
     'Activate.ps1',
     'activate.ps1',
-    'activate_this.py'
-]
-matcher = re.compile(r'^((?:python)*\d*\.*\d*(?:\.exe)*)$')
+    'activate_this.py',
+))
+PYTHON_NAMES = (b'python', b'pypy')
+_shebang_re = re.compile(br'#!\s*(\S+)')
 _activation_path_re = re.compile(
-    r'^(?:set -gx |setenv |set \"|)VIRTUAL_ENV[ =][\'\"]*(.*?)[\'\"]*\s*$'
+    br'^(?:set -gx |setenv |set \"|)VIRTUAL_ENV[ =][\'\"]*(.*?)[\'\"]*\s*$',
+    re.MULTILINE,
 )
+# Below this number of pyc files, starting worker processes costs more
+# than rewriting the files in the current process
+PARALLEL_PYCS_THRESHOLD = 256
 VERBOSE = False
 CLEAN = False
 MAGIC_LENGTH = 4 + 4  # magic length + 4 byte timestamp
@@ -59,117 +67,232 @@ def debug(msg):
 def _get_realpath(path):
     """Return real path without symlinks."""
     if os.path.exists(path):
-        return str(Path(path).resolve())
+        return os.path.realpath(path)
     return path
 
 
+def _open_for_reading(filename):
+    """Opens `filename` for binary reading without updating its access time
+    where the platform supports it.  O_NOATIME is only allowed to the owner
+    of the file, other files are opened normally.
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    noatime = getattr(os, 'O_NOATIME', 0)
+    try:
+        fd = os.open(filename, flags | noatime)
+    except PermissionError:  # pragma: no cover (not the owner of the file)
+        fd = os.open(filename, flags)
+    return os.fdopen(fd, 'rb')
+
+
+def _replace_file(filename, content):
+    """Writes `content` (str or bytes) to a temporary file next to `filename`
+    and renames it over `filename`, so the file is never seen half written.
+    Symlinks are followed, the permission bits are kept and the owner and
+    group are restored when allowed to.  The file gets a new inode: other
+    hardlinks keep the old content and extended attributes or ACLs are not
+    carried over.
+    """
+    filename = os.path.realpath(filename)
+    fd, tmp_filename = tempfile.mkstemp(
+        prefix='.{}.'.format(os.path.basename(filename)),
+        dir=os.path.dirname(filename),
+    )
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        st = os.stat(filename)
+        try:
+            os.chown(tmp_filename, st.st_uid, st.st_gid)
+        except (AttributeError, OSError):  # pragma: no cover (not allowed)
+            pass
+        # After chown, which may drop the setuid / setgid bits
+        shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:  # pragma: no cover (cleanup on failure)
+        os.remove(tmp_filename)
+        raise
+
+
+def _is_python_bin(name):
+    """Tells whether a bytes file name is a python interpreter such as
+    python, python3.9, pypy3 or python.exe.
+    """
+    if name.endswith(b'.exe'):
+        name = name[:-4]
+    for prefix in PYTHON_NAMES:
+        if name.startswith(prefix):
+            return not name[len(prefix):].strip(b'0123456789.')
+    return False
+
+
+def _is_lib_dir_name(name):
+    """Tells whether `name` is a versioned lib directory such as python3.9
+    for CPython or 3.9 for PyPy.
+    """
+    if name.startswith('python'):
+        name = name[len('python'):]
+    return not name.strip('0123456789.')
+
+
+def _handle_sub(match, new_path):
+    """Replaces the path captured by `_activation_path_re` with `new_path`."""
+    text = match.group()
+    start = match.start()
+    g_start, g_end = match.span(1)
+    return text[:(g_start - start)] + new_path + text[(g_end - start):]
+
+
 def update_activation_script(script_filename, new_path):
     """Updates the paths for the activate shell scripts."""
-    with open(script_filename) as f:
-        lines = list(f)
+    new_path = os.fsencode(new_path)
 
-    def _handle_sub(match):
-        text = match.group()
-        start, end = match.span()
-        g_start, g_end = match.span(1)
-        return text[:(g_start - start)] + new_path + text[(g_end - end):]
+    with _open_for_reading(script_filename) as f:
+        content = f.read()
 
-    changed = False
-    for idx, line in enumerate(lines):
-        new_line = _activation_path_re.sub(_handle_sub, line)
-        if line != new_line:
-            lines[idx] = new_line
-            changed = True
+    if b'VIRTUAL_ENV' not in content:
+        return
 
-    if changed:
+    # A single pass over the whole script, rather than one per line
+    new_content = _activation_path_re.sub(
+        functools.partial(_handle_sub, new_path=new_path), content,
+    )
+
+    if new_content != content:
         debug('A %s' % script_filename)
-        with open(script_filename, 'w') as f:
-            f.writelines(lines)
+        _replace_file(script_filename, new_content)
 
 
-def update_script(script_filename, new_path):
-    """Updates shebang lines for actual scripts."""
-    filesystem_encoding = sys.getfilesystemencoding()
-    new_path = new_path.encode(filesystem_encoding)
+def _update_shebang(line, new_path):
+    """Returns the shebang `line` pointing to the python in `new_path`, or
+    None if it is not an absolute python shebang or is already up-to-date.
+    """
+    match = _shebang_re.search(line)
+    if match is None:
+        return None
 
-    with open(script_filename, 'rb') as f:
-        if f.read(2) != (b'MZ' if IS_WINDOWS else b'#!'):
-            return
-        f.seek(0)
-        lines = list(f)
+    interpreter = match.group(1)
+    if not os.path.isabs(interpreter):
+        return None
 
-    found_shebang = False
-    for line_i, line in enumerate(lines):
+    bin_name = os.path.basename(interpreter)
+    if not _is_python_bin(bin_name):  # pragma: no cover
+        return None
 
-        shebang_offset = line.find(b'#!')
-        if shebang_offset == -1:
-            continue
+    new_bin = os.path.join(new_path, bin_name)
 
-        args = lines[line_i][shebang_offset + 2:].strip().split()
-        if not args:
-            continue
+    if interpreter == new_bin:
+        return None
 
-        if not os.path.isabs(args[0]):
-            continue
+    # Only the interpreter is swapped, its arguments are kept verbatim
+    return line[:match.start(1)] + new_bin + line[match.end(1):]
 
-        bin_name = Path(args[0].decode(filesystem_encoding)).name
-        if not matcher.match(bin_name):  # pragma: no cover
-            continue
 
-        new_bin = os.path.join(new_path, bin_name.encode(filesystem_encoding))
+def update_script(script_filename, new_path):
+    """Updates shebang lines for actual scripts.
 
-        if args[0] == new_bin:
-            continue
+    On POSIX only the first line is a shebang, so only that line is looked
+    at; Windows launchers embed it after the executable and are scanned.
+    """
+    new_path = os.fsencode(new_path)
 
-        line_offset = line_i
-        args_offset = shebang_offset + 2
-        found_shebang = True
-        break
+    with _open_for_reading(script_filename) as f:
+        head = f.read(256)
+        if not head.startswith(b'MZ' if IS_WINDOWS else b'#!'):
+            return
 
-    if not found_shebang:
-        return
+        if IS_WINDOWS:  # pragma: no cover (Windows only)
+            # Launchers embed the shebang somewhere after the executable
+            lines = (head + f.read()).split(b'\n')
+            for line_i, line in enumerate(lines):
+                new_line = _update_shebang(line, new_path)
+                if new_line is not None:
+                    lines[line_i] = new_line
+                    break
+            else:
+                return
+            content = b'\n'.join(lines)
+        else:
+            # The shebang is the first line, the rest of the script is only
+            # read when it has to be rewritten
+            if b'\n' not in head:
+                head += f.readline()
+            line, sep, rest = head.partition(b'\n')
+            new_line = _update_shebang(line, new_path)
+            if new_line is None:
+                return
+            content = new_line + sep + rest + f.read()
 
-    args[0] = new_bin
-    lines[line_offset] = lines[line_offset][:args_offset] + b" ".join(args) + b"\n"
     debug('S %s' % script_filename)
-    with open(script_filename, 'wb') as f:
-        f.writelines(lines)
+    _replace_file(script_filename, content)
 
 
 def update_scripts(bin_dir, new_path):
     """Updates all scripts in the bin folder."""
-    for fname in os.listdir(bin_dir):
-        path = os.path.join(bin_dir, fname)
-        if fname in ACTIVATION_SCRIPTS:
-            update_activation_script(path, new_path)
-        elif os.path.isfile(path):
-            update_script(path, new_path)
-
-
-def update_pyc(filename, new_path):
-    """Updates the filenames stored in pyc files."""
-    f = open(filename, 'rb')
-    magic = f.read(MAGIC_LENGTH)
+    # Encoded once here, os.fsencode() passes bytes through in the callees
+    new_path = os.fsencode(new_path)
+    with os.scandir(bin_dir) as entries:
+        for entry in entries:
+            # Symlinks may point outside of the virtualenv, never follow them
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if entry.name in ACTIVATION_SCRIPTS:
+                update_activation_script(entry.path, new_path)
+            else:
+                update_script(entry.path, new_path)
+
+
+def _filenames_match(code, filename):
+    """Tells whether `code` and all its nested code objects already have
+    `filename` as co_filename, without rebuilding anything.
+    """
+    codes = [code]
+    while codes:
+        code = codes.pop()
+        if code.co_filename != filename:
+            return False
+        codes.extend(const for const in code.co_consts if type(const) is CodeType)
+    return True
+
+
+def _rewrite_pyc(task):
+    """Rewrites the filenames stored in a pyc file.  `task` is a
+    `(filename, new_path)` tuple so this can be mapped over a process pool.
+
+    Returns True if the file was updated, False if it was already up-to-date
+    and None if it could not be loaded.  Nothing is printed here, reporting
+    is left to the calling process.
+    """
+    filename, new_path = task
+    with _open_for_reading(filename) as f:
+        data = f.read()
+    magic = data[:MAGIC_LENGTH]
     try:
-        code = marshal.load(f)
-        f.close()
+        # a memoryview avoids copying the body just to skip the header
+        code = marshal.loads(memoryview(data)[MAGIC_LENGTH:])
     except Exception:
-        print('Error in %s' % filename)
-        f.close()
-        if CLEAN:
-            os.remove(filename)
-            print('Deleted %s' % filename)
-        return
+        return None
+
+    if _filenames_match(code, new_path):
+        return False
 
     def _make_code(code, filename, consts):
-        if sys.version_info[0] == 2:  # pragma: no cover (PY2)
+        if hasattr(code, 'replace'):  # pragma: no cover (py38+)
+            # Only pass what changed, the other fields are reused as-is
+            changes = {}
+            if filename != code.co_filename:
+                changes['co_filename'] = filename
+            if consts is not code.co_consts:
+                changes['co_consts'] = tuple(consts)
+            return code.replace(**changes)
+        elif sys.version_info[0] == 2:  # pragma: no cover (PY2)
             return CodeType(
                 code.co_argcount, code.co_nlocals, code.co_stacksize,
                 code.co_flags, code.co_code, tuple(consts), code.co_names,
                 code.co_varnames, filename, code.co_name, code.co_firstlineno,
                 code.co_lnotab, code.co_freevars, code.co_cellvars,
             )
-        elif sys.version_info < (3, 8):  # pragma: no cover (<py38)
+        else:  # pragma: no cover (<py38)
             return CodeType(
                 code.co_argcount, code.co_kwonlyargcount, code.co_nlocals,
                 code.co_stacksize, code.co_flags, code.co_code, tuple(consts),
@@ -177,39 +300,87 @@ def update_pyc(filename, new_path):
                 code.co_firstlineno, code.co_lnotab, code.co_freevars,
                 code.co_cellvars,
             )
-        else:  # pragma: no cover (py38+)
-            return code.replace(co_consts=tuple(consts), co_filename=filename)
 
     def _process(code):
-        consts = []
-        for const in code.co_consts:
-            if type(const) is CodeType:
-                const = _process(const)
-            consts.append(const)
-        if new_path != code.co_filename or consts != list(code.co_consts):
-            code = _make_code(code, new_path, consts)
-        return code
-
-    new_code = _process(code)
-
-    if new_code is not code:
+        # Post-order walk with an explicit stack of (code, consts so far).
+        # Changes are tracked by identity: code objects compare equal
+        # whatever their co_filename, so comparing the consts is not enough
+        stack = [(code, [])]
+        while True:
+            code, consts = stack[-1]
+            if len(consts) < len(code.co_consts):
+                const = code.co_consts[len(consts)]
+                if type(const) is CodeType:
+                    stack.append((const, []))
+                else:
+                    consts.append(const)
+                continue
+
+            stack.pop()
+            if any(new is not old for new, old in zip(consts, code.co_consts)):
+                code = _make_code(code, new_path, consts)
+            elif new_path != code.co_filename:
+                code = _make_code(code, new_path, code.co_consts)
+            if not stack:
+                return code
+            stack[-1][1].append(code)
+
+    _replace_file(filename, magic + marshal.dumps(_process(code)))
+    return True
+
+
+def _report_pyc(filename, result):
+    """Prints the outcome of `_rewrite_pyc` and cleans unloadable files."""
+    if result is None:
+        print('Error in %s' % filename)
+        if CLEAN:
+            os.remove(filename)
+            print('Deleted %s' % filename)
+    elif result:
         debug('B %s' % filename)
-        with open(filename, 'wb') as f:
-            f.write(magic)
-            marshal.dump(new_code, f)
+
+
+def update_pyc(filename, new_path):
+    """Updates the filenames stored in pyc files."""
+    _report_pyc(filename, _rewrite_pyc((filename, new_path)))
+
+
+def _iter_files(path, suffixes):
+    """Yields the directory entries of the regular files below `path` whose
+    name ends with one of `suffixes`.  Symlinks are not followed and the file
+    type cached by `os.scandir` is used instead of stat calls.
+    """
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.name.endswith(suffixes) and entry.is_file(follow_symlinks=False):
+                    yield entry
 
 
 def update_pycs(lib_dir, new_path):
-    """Walks over all pyc files and updates their paths."""
-    def get_new_path(filename):
-        filename = Path(os.path.normpath(filename)).name
-        return os.path.join(new_path, filename)
+    """Walks over all pyc files and updates their paths.
+
+    Files are independent from each other so, past PARALLEL_PYCS_THRESHOLD
+    files, they are rewritten in a pool of processes; results are reported in
+    walk order.
+    """
+    prefix = os.path.join(new_path, '')
+    tasks = [
+        (entry.path, prefix + entry.name)
+        for entry in _iter_files(lib_dir, ('.pyc', '.pyo'))
+    ]
+    if len(tasks) < PARALLEL_PYCS_THRESHOLD:
+        for filename, local_path in tasks:
+            update_pyc(filename, local_path)
+        return
 
-    pycs = Path(lib_dir).glob('**/*.pyc')
-    pyos = Path(lib_dir).glob('**/*.pyo')
-    for pyc in [*pycs, *pyos]:
-        local_path = get_new_path(pyc)
-        update_pyc(pyc, local_path)
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(_rewrite_pyc, tasks, chunksize=64)
+        for (filename, _), result in zip(tasks, results):
+            _report_pyc(filename, result)
 
 
 def _update_pth_file(pth_filename, orig_path, is_pypy):
@@ -233,17 +404,16 @@ def _update_pth_file(pth_filename, orig_path, is_pypy):
         relto_pth = os.path.join(rel, relto_original)
         lines[i] = '{}\n'.format(relto_pth)
     if changed:
-        with open(pth_filename, 'w') as f:
-            f.write(''.join(lines))
+        _replace_file(pth_filename, ''.join(lines))
         debug('P {}'.format(pth_filename))
 
 
 def update_pth_files(site_packages, orig_path, is_pypy):
     """Converts /full/paths in pth files to relative relocatable paths."""
-    for filename in os.listdir(site_packages):
-        filename = os.path.join(site_packages, filename)
-        if filename.endswith(('.pth', '.egg-link')) and os.path.isfile(filename):
-            _update_pth_file(filename, orig_path, is_pypy)
+    with os.scandir(site_packages) as entries:
+        for entry in entries:
+            if entry.name.endswith(('.pth', '.egg-link')) and entry.is_file():
+                _update_pth_file(entry.path, orig_path, is_pypy)
 
 
 def update_pyvenv_cfg(pyvenv_cfg, new_path):
@@ -266,8 +436,7 @@ def update_pyvenv_cfg(pyvenv_cfg, new_path):
     if path.strip() == new_path:
         return
 
-    with open(pyvenv_cfg, 'w') as f:
-        f.writelines(lines)
+    _replace_file(pyvenv_cfg, ''.join(lines))
     debug('C {}'.format(pyvenv_cfg))
 
 
@@ -299,17 +468,29 @@ def get_orig_path(venv_path):
     """
     activate_path = os.path.join(venv_path, f'{BIN_DIR}/activate')
 
-    with open(activate_path) as activate:
-        for line in activate:
-            # virtualenv 20 changes the position
-            for possible in ('VIRTUAL_ENV="', "VIRTUAL_ENV='"):
-                if line.startswith(possible):
-                    return line.split(possible[-1], 2)[1]
-        else:
-            raise AssertionError(
-                'Could not find VIRTUAL_ENV= in activation script: %s' %
-                activate_path
-            )
+    with _open_for_reading(activate_path) as activate:
+        content = b'\n' + activate.read()
+
+    # virtualenv 20 changes the position, look for the first quoted one
+    marker = b'\nVIRTUAL_ENV='
+    start = content.find(marker)
+    while start != -1:
+        start += len(marker)
+        quote = content[start:start + 1]
+        if quote in (b'"', b"'"):
+            # The closing quote has to be on the same line
+            line_end = content.find(b'\n', start)
+            if line_end == -1:
+                line_end = len(content)
+            end = content.find(quote, start + 1, line_end)
+            if end != -1:
+                return os.fsdecode(content[start + 1:end])
+        start = content.find(marker, start)
+
+    raise AssertionError(
+        'Could not find VIRTUAL_ENV= in activation script: %s' %
+        activate_path
+    )
 
 
 PyInst = collections.namedtuple(
@@ -395,11 +576,10 @@ def _get_virtualenv_state(path, new_path=None):
     if IS_WINDOWS:  # pragma: no cover (Windows only)
         lib_dir = base_lib_dir
     else:
-        lib_dirs = [
-            os.path.join(base_lib_dir, potential_lib_dir)
-            for potential_lib_dir in os.listdir(base_lib_dir)
-            if matcher.match(potential_lib_dir)
-        ]
+        with os.scandir(base_lib_dir) as entries:
+            lib_dirs = [
+                entry.path for entry in entries if _is_lib_dir_name(entry.name)
+            ]
         if len(lib_dirs) != 1:
             raise NotAVirtualenvError(
                 path,